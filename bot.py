@@ -6,34 +6,92 @@ load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), ".env"))
 
 print("Token loaded?", bool(os.getenv("DISCORD_TOKEN")))
 
+import asyncio
+import hashlib
 import json
+import re
 import secrets
 from typing import Dict, List, Tuple
 
+import msgpack
+
 import discord
 from discord import app_commands
 from discord.ext import commands
 
-CONFIG_FILE = "roll_config.json"
+CONFIG_FILE = "roll_config.msgpack"
+# Older installs wrote indented JSON here; read it once and let the next
+# save persist in the new format.
+LEGACY_CONFIG_FILE = "roll_config.json"
 
 
 # -----------------------------
 # Config helpers (per guild)
 # -----------------------------
-def load_config() -> Dict[str, dict]:
-    if not os.path.exists(CONFIG_FILE):
+def _serialize(cfg: Dict[int, dict]) -> bytes:
+    # String keys on disk (matches the legacy JSON layout); in memory we keep
+    # the int guild ids. Per-guild keys starting with "_" are derived caches;
+    # keep them off disk.
+    clean = {
+        str(k): {gk: gv for gk, gv in v.items() if not gk.startswith("_")}
+        if isinstance(v, dict) else v
+        for k, v in cfg.items()
+    }
+    return msgpack.packb(clean, use_bin_type=True)
+
+
+def load_config() -> Dict[int, dict]:
+    if os.path.exists(CONFIG_FILE):
+        with open(CONFIG_FILE, "rb") as f:
+            raw = msgpack.unpackb(f.read(), raw=False)
+    elif os.path.exists(LEGACY_CONFIG_FILE):
+        with open(LEGACY_CONFIG_FILE, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+    else:
         return {}
-    with open(CONFIG_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+    # Guild ids become ints; bookkeeping keys like "_command_hash" stay as-is.
+    return {int(k) if k.isdigit() else k: v for k, v in raw.items()}
+
+
+# Last bytes written to disk; lets the save path skip writes when nothing changed.
+_last_serialized: bytes = b""
 
 
-def save_config(cfg: Dict[str, dict]) -> None:
-    with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-        json.dump(cfg, f, indent=2, ensure_ascii=False)
+def _save_sync(cfg: Dict[int, dict]) -> None:
+    global _last_serialized
+    new = _serialize(cfg)
+    if new == _last_serialized:
+        return
+    tmp = CONFIG_FILE + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(new)
+    os.replace(tmp, CONFIG_FILE)
+    _last_serialized = new
+
+
+# Debounced saves: back-to-back /set* commands mark the config dirty and
+# share one disk write instead of writing once per command.
+SAVE_DEBOUNCE_SECONDS = 0.5
+_dirty = False
+_flush_scheduled = False
+
+
+def _flush() -> None:
+    global _dirty, _flush_scheduled
+    _flush_scheduled = False
+    if not _dirty:
+        return
+    _dirty = False
+    # Run the disk write in a worker thread so it never blocks the event loop.
+    asyncio.get_running_loop().run_in_executor(None, _save_sync, cfg)
 
 
-def guild_key(guild_id: int) -> str:
-    return str(guild_id)
+def schedule_save() -> None:
+    global _dirty, _flush_scheduled
+    _dirty = True
+    if not _flush_scheduled:
+        _flush_scheduled = True
+        asyncio.get_running_loop().call_later(SAVE_DEBOUNCE_SECONDS, _flush)
 
 
 def default_guild_config() -> dict:
@@ -57,18 +115,80 @@ def default_guild_config() -> dict:
     }
 
 
-def get_guild_config(cfg: Dict[str, dict], guild_id: int) -> dict:
-    k = guild_key(guild_id)
-    if k not in cfg:
-        cfg[k] = default_guild_config()
-        save_config(cfg)
-    return cfg[k]
+def rebuild_roll_cache(gconf: dict) -> None:
+    """Recompute the alias tables weighted_choice samples from.
+
+    Vose's alias method: O(n) build here, O(1) per sample. Weights total
+    100, so scaling by n keeps every threshold an exact integer out of 100.
+    """
+    outcomes = gconf["outcomes"]
+    n = len(outcomes)
+    scaled = [o["weight"] * n for o in outcomes]
+    prob = [100] * n
+    alias = list(range(n))
+    small = [i for i in range(n) if scaled[i] < 100]
+    large = [i for i in range(n) if scaled[i] >= 100]
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] -= 100 - scaled[s]
+        (small if scaled[l] < 100 else large).append(l)
+    gconf["_alias_prob"] = prob
+    gconf["_alias_alias"] = alias
+    gconf["_names"] = [o["name"] for o in outcomes]
+
+
+# guild_id -> (channel_id, message_id, emoji_str) for guilds with a live
+# roller message. Lets the reaction handler reject with integer compares
+# before touching the config at all.
+_trigger_index: Dict[int, Tuple[int, int, str]] = {}
+
+
+def update_trigger_index(guild_id: int, gconf: dict) -> None:
+    if gconf.get("trigger_message_id") and gconf.get("trigger_channel_id"):
+        _trigger_index[guild_id] = (
+            gconf["trigger_channel_id"],
+            gconf["trigger_message_id"],
+            str(gconf["trigger_emoji"]),
+        )
+    else:
+        _trigger_index.pop(guild_id, None)
+
+
+def refresh_guild_cache(guild_id: int, gconf: dict) -> None:
+    """Rebuild everything derived from a guild config after a mutation.
+
+    The hot path reads one tuple instead of chasing five dict keys.
+    """
+    rebuild_roll_cache(gconf)
+    gconf["_tuple"] = (
+        gconf["trigger_message_id"],
+        gconf["trigger_channel_id"],
+        gconf["trigger_emoji"],
+        gconf["mod_channel_id"],
+        gconf["_names"],
+        gconf["_alias_prob"],
+        gconf["_alias_alias"],
+    )
+    update_trigger_index(guild_id, gconf)
+
+
+def get_guild_config(cfg: Dict[int, dict], guild_id: int) -> dict:
+    gconf = cfg.get(guild_id)
+    if gconf is None:
+        # The in-memory default is enough until a /set* command actually
+        # changes something; no point writing pure defaults to disk.
+        gconf = cfg[guild_id] = default_guild_config()
+    if "_tuple" not in gconf:
+        refresh_guild_cache(guild_id, gconf)
+    return gconf
 
 
 def validate_outcomes(outcomes: List[dict]) -> Tuple[bool, str]:
     if not outcomes:
         return False, "You must provide at least one outcome."
-    total = 0
     for o in outcomes:
         if "name" not in o or "weight" not in o:
             return False, "Each outcome must have 'name' and 'weight'."
@@ -76,7 +196,7 @@ def validate_outcomes(outcomes: List[dict]) -> Tuple[bool, str]:
             return False, "Outcome name must be a non-empty string."
         if not isinstance(o["weight"], int) or o["weight"] < 0:
             return False, "Outcome weight must be a non-negative integer."
-        total += o["weight"]
+    total = sum(o["weight"] for o in outcomes)
     if total != 100:
         return False, f"Outcome weights must total 100 (currently {total})."
     return True, "OK"
@@ -85,31 +205,39 @@ def validate_outcomes(outcomes: List[dict]) -> Tuple[bool, str]:
 # -----------------------------
 # True randomness helpers
 # -----------------------------
-def roll_d100() -> int:
-    return secrets.randbelow(100) + 1
+def draw_roll(n: int) -> Tuple[int, int, int]:
+    """One CSPRNG call covering the whole roll: d100, alias column, alias threshold.
 
+    Reducing 16-bit chunks mod 100 (or mod n, a few dozen at most) leaves
+    a bias on the order of 1/2^16 — irrelevant here.
+    """
+    b = secrets.token_bytes(6)
+    d100 = int.from_bytes(b[0:2], "big") % 100 + 1
+    i = int.from_bytes(b[2:4], "big") % n
+    r = int.from_bytes(b[4:6], "big") % 100
+    return d100, i, r
 
-def weighted_choice(outcomes: List[dict]) -> str:
-    r = secrets.randbelow(100)  # 0..99
-    cumulative = 0
-    for o in outcomes:
-        cumulative += o["weight"]
-        if r < cumulative:
-            return o["name"]
-    return outcomes[-1]["name"]
+
+def weighted_choice(names: List[str], prob: List[int], alias: List[int], i: int, r: int) -> str:
+    return names[i] if r < prob[i] else names[alias[i]]
 
 
 # -----------------------------
 # Bot setup
 # -----------------------------
+# Reaction events are all we consume; not subscribing to message dispatch
+# keeps the gateway from streaming every chat message to us.
 intents = discord.Intents.default()
 intents.reactions = True
 intents.guilds = True
 intents.members = False
-intents.messages = True
+intents.messages = False
 
 bot = commands.Bot(command_prefix="!", intents=intents)
 cfg = load_config()
+for _k, _g in cfg.items():
+    if isinstance(_g, dict):
+        refresh_guild_cache(_k, _g)
 
 
 def is_mod(interaction: discord.Interaction) -> bool:
@@ -119,12 +247,27 @@ def is_mod(interaction: discord.Interaction) -> bool:
     return perms.manage_messages or perms.administrator
 
 
+def _command_spec_hash() -> str:
+    spec = repr([
+        (c.name, c.description, [(p.name, str(p.type)) for p in c.parameters])
+        for c in bot.tree.get_commands()
+    ])
+    return hashlib.sha1(spec.encode()).hexdigest()
+
+
 @bot.event
 async def on_ready():
-    try:
-        await bot.tree.sync()
-    except Exception as e:
-        print("Command sync failed:", e)
+    # Syncing is a slow global POST and counts against the registration
+    # quota; only do it when the command spec actually changed.
+    h = _command_spec_hash()
+    if cfg.get("_command_hash") != h:
+        try:
+            await bot.tree.sync()
+        except Exception as e:
+            print("Command sync failed:", e)
+        else:
+            cfg["_command_hash"] = h
+            schedule_save()
 
     print(f"Logged in as {bot.user} (id={bot.user.id})")
 
@@ -142,7 +285,8 @@ async def setmodchannel(interaction: discord.Interaction, channel: discord.TextC
 
     gconf = get_guild_config(cfg, interaction.guild.id)
     gconf["mod_channel_id"] = channel.id
-    save_config(cfg)
+    refresh_guild_cache(interaction.guild.id, gconf)
+    schedule_save()
 
     await interaction.response.send_message(f"✅ Mod log channel set to {channel.mention}", ephemeral=True)
 
@@ -156,11 +300,16 @@ async def setemoji(interaction: discord.Interaction, emoji: str):
 
     gconf = get_guild_config(cfg, interaction.guild.id)
     gconf["trigger_emoji"] = emoji
-    save_config(cfg)
+    refresh_guild_cache(interaction.guild.id, gconf)
+    schedule_save()
 
     await interaction.response.send_message(f"✅ Trigger emoji set to: {emoji}", ephemeral=True)
 
 
+# "name=weight" entries separated by ";"; whitespace around either is ignored.
+_ODDS_RE = re.compile(r"\s*([^=;]+?)\s*=\s*(\d+)\s*(?:;|$)")
+
+
 @bot.tree.command(name="setodds", description="Set the weighted outcome percentages (must total 100).")
 @app_commands.describe(
     odds="Format: name=weight; name=weight; ... (example: powers, curse=25; powers, blessing=25; no powers=50)"
@@ -172,16 +321,15 @@ async def setodds(interaction: discord.Interaction, odds: str):
         return await interaction.response.send_message("You need Manage Messages (or Admin) to do this.", ephemeral=True)
 
     parsed: List[dict] = []
-    parts = [p.strip() for p in odds.split(";") if p.strip()]
-    for p in parts:
-        if "=" not in p:
-            return await interaction.response.send_message("❌ Bad format. Use: name=weight; ...", ephemeral=True)
-        name, weight_str = p.split("=", 1)
-        name = name.strip()
-        weight_str = weight_str.strip()
-        if not weight_str.isdigit():
-            return await interaction.response.send_message(f"❌ Weight must be an integer: `{p}`", ephemeral=True)
-        parsed.append({"name": name, "weight": int(weight_str)})
+    pos = 0
+    for m in _ODDS_RE.finditer(odds):
+        if m.start() != pos:
+            break
+        parsed.append({"name": m.group(1), "weight": int(m.group(2))})
+        pos = m.end()
+    # The matches must tile the whole string; leftovers mean a bad entry.
+    if not parsed or pos != len(odds):
+        return await interaction.response.send_message("❌ Bad format. Use: name=weight; ...", ephemeral=True)
 
     ok, msg = validate_outcomes(parsed)
     if not ok:
@@ -189,7 +337,8 @@ async def setodds(interaction: discord.Interaction, odds: str):
 
     gconf = get_guild_config(cfg, interaction.guild.id)
     gconf["outcomes"] = parsed
-    save_config(cfg)
+    refresh_guild_cache(interaction.guild.id, gconf)
+    schedule_save()
 
     pretty = "\n".join([f"- **{o['name']}**: {o['weight']}%" for o in parsed])
     await interaction.response.send_message(f"✅ Odds updated:\n{pretty}", ephemeral=True)
@@ -214,7 +363,8 @@ async def postroller(interaction: discord.Interaction, channel: discord.TextChan
 
     gconf["trigger_message_id"] = roller_msg.id
     gconf["trigger_channel_id"] = channel.id
-    save_config(cfg)
+    refresh_guild_cache(interaction.guild.id, gconf)
+    schedule_save()
 
     await interaction.response.send_message(
         f"✅ Roller posted in {channel.mention} (message id: `{roller_msg.id}`)\nUsers must react with {emoji}.",
@@ -280,66 +430,113 @@ async def editrolllog(interaction: discord.Interaction, message_id: str, new_tex
 # -----------------------------
 # Reaction trigger (emoji roll)
 # -----------------------------
+# Message bodies built once at import; the hot path only fills in values.
+_DM_TMPL = (
+    "🎲 **Your roll:** {d100}/100\n"
+    "✨ **Outcome:** {outcome}\n\n"
+    "(Triggered by reacting with {emoji} in **{guild}**.)"
+)
+
+_MOD_LOG_TMPL = (
+    "📋 **Roll Log**\n"
+    "User: {mention} (`{uid}`)\n"
+    "Roll: **{d100}**/100\n"
+    "Outcome: **{outcome}**\n"
+    "DM delivered: {dm}\n"
+    "Trigger message: `{tmid}` in <#{tcid}>"
+)
+
+
+async def _send_roll_dm(guild: discord.Guild, user_id: int, d100: int, outcome: str, trigger_emoji: str) -> None:
+    user = guild.get_member(user_id)
+    if user is None:
+        user = await bot.fetch_user(user_id)
+    await user.send(_DM_TMPL.format_map(
+        {"d100": d100, "outcome": outcome, "emoji": trigger_emoji, "guild": guild.name}
+    ))
+
+
 @bot.event
 async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
     if payload.user_id == bot.user.id:
         return
 
-    guild = bot.get_guild(payload.guild_id) if payload.guild_id else None
-    if not guild:
-        return
-
-    gconf = get_guild_config(cfg, guild.id)
-    trigger_message_id = gconf.get("trigger_message_id")
-    trigger_channel_id = gconf.get("trigger_channel_id")
-    trigger_emoji = gconf.get("trigger_emoji")
-
-    if not trigger_message_id or not trigger_channel_id:
+    # Cheap rejects first: most reactions are not on a roller message.
+    t = _trigger_index.get(payload.guild_id) if payload.guild_id else None
+    if not t:
         return
-
+    trigger_channel_id, trigger_message_id, trigger_emoji = t
     if payload.message_id != trigger_message_id or payload.channel_id != trigger_channel_id:
         return
+    # Canonical form matching PartialEmoji.__str__, without the method call;
+    # for unicode emoji (the common case) this is just the name, no allocation.
+    e = payload.emoji
+    if e.id is None:
+        emoji_str = e.name
+    elif e.animated:
+        emoji_str = f"<a:{e.name}:{e.id}>"
+    else:
+        emoji_str = f"<:{e.name}:{e.id}>"
+    if emoji_str != trigger_emoji:
+        return
 
-    if str(payload.emoji) != str(trigger_emoji):
+    guild = bot.get_guild(payload.guild_id)
+    if not guild:
         return
 
-    member = guild.get_member(payload.user_id)
-    user = member if member is not None else await bot.fetch_user(payload.user_id)
+    gconf = get_guild_config(cfg, guild.id)
+    # Everything the hot path needs, in one lookup.
+    _tmid, _tcid, _temoji, mod_channel_id, names, prob, alias = gconf["_tuple"]
 
-    d100 = roll_d100()
-    outcome = weighted_choice(gconf["outcomes"])
+    # The mod log only needs mention/id, both derivable from the payload;
+    # resolve a full user object lazily and only for the DM.
+    mention = f"<@{payload.user_id}>"
 
-    dm_ok = True
-    try:
-        await user.send(
-            f"🎲 **Your roll:** {d100}/100\n"
-            f"✨ **Outcome:** {outcome}\n\n"
-            f"(Triggered by reacting with {trigger_emoji} in **{guild.name}**.)"
-        )
-    except (discord.Forbidden, discord.HTTPException):
-        dm_ok = False
+    d100, i, r = draw_roll(len(names))
+    outcome = weighted_choice(names, prob, alias, i, r)
 
-    mod_channel_id = gconf.get("mod_channel_id")
+    mod_ch = None
     if mod_channel_id:
-        mod_ch = guild.get_channel(mod_channel_id)
-        if isinstance(mod_ch, discord.TextChannel):
-            content = (
-                f"📋 **Roll Log**\n"
-                f"User: {user.mention} (`{user.id}`)\n"
-                f"Roll: **{d100}**/100\n"
-                f"Outcome: **{outcome}**\n"
-                f"DM delivered: {'✅' if dm_ok else '❌ (user has DMs closed?)'}\n"
-                f"Trigger message: `{trigger_message_id}` in <#{trigger_channel_id}>"
-            )
-            await mod_ch.send(content)
-
-    try:
-        channel = guild.get_channel(payload.channel_id)
-        if isinstance(channel, discord.TextChannel):
-            msg = await channel.fetch_message(payload.message_id)
-            await msg.remove_reaction(payload.emoji, user)
-    except Exception:
-        pass
+        ch = guild.get_channel(mod_channel_id)
+        if isinstance(ch, discord.TextChannel):
+            mod_ch = ch
+
+    # Log content is built optimistically; the DM rarely fails, and when it
+    # does we edit the log afterwards instead of serializing on the DM.
+    log_fields = {
+        "mention": mention,
+        "uid": payload.user_id,
+        "d100": d100,
+        "outcome": outcome,
+        "dm": "✅",
+        "tmid": trigger_message_id,
+        "tcid": trigger_channel_id,
+    }
+    content = _MOD_LOG_TMPL.format_map(log_fields)
+
+    # Fire the three REST calls concurrently; total latency is the max of
+    # the three instead of their sum.
+    coros = [
+        _send_roll_dm(guild, payload.user_id, d100, outcome, trigger_emoji),
+        # One DELETE straight to the API; no need to fetch the message first.
+        bot.http.remove_reaction(
+            payload.channel_id,
+            payload.message_id,
+            payload.emoji._as_reaction(),
+            payload.user_id,
+        ),
+    ]
+    if mod_ch:
+        coros.append(mod_ch.send(content))
+    results = await asyncio.gather(*coros, return_exceptions=True)
+
+    dm_ok = not isinstance(results[0], Exception)
+    if not dm_ok and mod_ch and not isinstance(results[2], Exception):
+        log_fields["dm"] = "❌ (user has DMs closed?)"
+        try:
+            await results[2].edit(content=_MOD_LOG_TMPL.format_map(log_fields))
+        except discord.HTTPException:
+            pass
 
 
 # -----------------------------
@@ -353,5 +550,10 @@ print("Has dot:", "." in TOKEN if TOKEN else None)
 if not TOKEN:
     raise RuntimeError("Set DISCORD_TOKEN environment variable.")
 
-bot.run(TOKEN)
+try:
+    bot.run(TOKEN)
+finally:
+    # Write out anything still sitting in the debounce window.
+    if _dirty:
+        _save_sync(cfg)
 